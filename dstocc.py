@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 '''dstocc - Loads dirsearch JSON output and captures result with CutyCapt'''
@@ -9,16 +9,18 @@ version = '0.1'
 license = 'GPLv2'
 
 try:
-    import json
-    import time
+    import os
+    import ijson
+    import shlex
+    import signal
     import string
     import argparse
     import subprocess
     import logging as log
 
-    from Queue import Queue
-    from random import shuffle
-    from threading import Thread
+    from random import sample, shuffle
+    from threading import Event, Lock
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
     # PyInstaller requires explicit import of exit
     from sys import exit
@@ -26,27 +28,77 @@ try:
 except ImportError as missing:
     print(
         'UNKNOWN - Could not import all required modules: "%s".\n' % missing +
-        'The script requires Python 2.7 or 2.6 with the "argparse" module\n'
-        'Installation with PIP: "pip install argparse"')
+        'The script requires Python 3.7 or later with the "ijson" module\n'
+        'Installation with PIP: "pip install ijson"')
 
     exit(3)
 
 # -----------------------------------------------------------------------------
 
+class DeletionTable(dict):
+    '''Translation table that deletes all characters which are not mapped'''
+
+    def __missing__(self, codepoint):
+        return None
+
+
+# Translates URLs to filenames of output images in a single pass, keeping
+# "safe" characters, replacing path and port separators and deleting the rest
+safe_chars = string.ascii_letters + string.digits + '-_.='
+
+file_name_table = DeletionTable((ord(char), ord(char)) for char in safe_chars)
+file_name_table[ord('/')] = ord('_')
+file_name_table[ord(':')] = ord('-')
+
+# Process groups of running commands, which are killed if capturing is stopped
+running_pids = set()
+running_pids_lock = Lock()
+stopping_captures = Event()
+
+# -----------------------------------------------------------------------------
+
 def split_status_codes(status_code_string):
-    '''Split a comma separated string with status codes into a list'''
+    '''Split a comma separated string with status codes into a set'''
     
     status_codes = status_code_string.split(',')
 
     try:
-        status_codes = map(int, status_codes)
+        status_codes = frozenset(map(int, status_codes))
 
-    except:
+    except ValueError:
         raise argparse.ArgumentTypeError('Status codes must to be integers')
 
     return status_codes
 
 
+def positive_int(value_string):
+    '''Convert a string to an integer which must be larger than zero'''
+
+    try:
+        value = int(value_string)
+
+    except ValueError:
+        raise argparse.ArgumentTypeError('Value must be an integer')
+
+    if value < 1:
+        raise argparse.ArgumentTypeError('Value must be larger than zero')
+
+    return value
+
+
+def split_command_template(command_template):
+    '''Split a command template into a list of arguments like a shell would'''
+
+    try:
+        command_tokens = shlex.split(command_template)
+
+    except ValueError as error_msg:
+        raise argparse.ArgumentTypeError(
+            'Failed to parse command template: %s' % error_msg)
+
+    return command_tokens
+
+
 def parse_args():
     '''Parses commandline arguments provided by the user'''
 
@@ -59,23 +111,28 @@ def parse_args():
     parser.add_argument(
         '-f', '--file', dest='results_file',
         help='Path to dirsearch JSON output file',
-        metavar='/path/to/results.json', type=argparse.FileType('r'),
+        metavar='/path/to/results.json', type=argparse.FileType('rb'),
         required=True)
 
     parser.add_argument(
         '-i', '--include', dest='included_codes',
         help='HTTP status codes to include in CutyCapt (default: All)',
-        metavar='"200,500"', type=split_status_codes, default=[])
+        metavar='"200,500"', type=split_status_codes, default=frozenset())
 
     parser.add_argument(
         '-e', '--exclude', dest='excluded_codes',
         help='HTTP status codes to exclude in CutyCapt (default: None)',
-        metavar='"403,404"', type=split_status_codes, default=[])
+        metavar='"403,404"', type=split_status_codes, default=frozenset())
 
     parser.add_argument(
-        '-c', '--command-template',
+        '-l', '--limit', dest='url_limit',
+        help='Maximum number of random URLs to capture (default: All)',
+        metavar='INT', type=positive_int, default=None)
+
+    parser.add_argument(
+        '-c', '--command-template', dest='command_tokens',
         help='Template for CutyCapt shell command (default: %(default)s)',
-        metavar='CMD', type=str,
+        metavar='CMD', type=split_command_template,
         default=(
             'CutyCapt --url=%URL% --out=%FILENAME% '
             '--min-width=1024 --min-height=768'))
@@ -90,6 +147,11 @@ def parse_args():
         help='Number of threads for CutyCapt workers (default: 4)',
         metavar='INT', type=int, default=4)
 
+    parser.add_argument(
+        '-x', '--xvfb', dest='use_xvfb',
+        help='Run CutyCapt on a shared Xvfb server started by the script',
+        action='store_true', default=False)
+
     parser.add_argument(
         '-V', '--verbose', dest='log_verbose',
         help='Enable verbose application logging',
@@ -104,132 +166,194 @@ def parse_args():
 
 # -----------------------------------------------------------------------------
 
-def load_target_urls(results_file, included_codes, excluded_codes):
+def load_target_urls(results_file, included_codes, excluded_codes, url_limit):
     '''Loads JSON results file and filters out URLs that should be CutyCaped'''
 
     log.debug('Loading resuls from JSON file')
 
-    # Strips leading NULL characters and loads JSON from the results file
-    results_string = results_file.read()
+    # Argparse before Python 3.9 returns text mode stdin for "-" in binary mode
+    results_file = getattr(results_file, 'buffer', results_file)
 
-    results_string = results_string[results_string.index('{'):]
-    results = json.loads(results_string)
+    # Skips leading NULL characters before the JSON object in the results file,
+    # peeking at buffered data so that non-seekable input like stdin works
+    while True:
+        chunk = results_file.peek()
+
+        if not chunk:
+            raise ValueError('Could not find JSON object in results file')
 
-    log.debug('dirsearch result data: "%s"' % str(results))
+        position = chunk.find(b'{')
 
-    # Filters the sub-paths that should be captured
-    target_urls = []
+        if position != -1:
+            results_file.read(position)
 
-    for url in results.iterkeys():
-        log.debug('Checking sub-paths for URL "%s"' % url)
+            break
 
-        sub_paths = results[url]
+        results_file.read(len(chunk))
 
-        for sub_path in sub_paths:
-            log.debug('Checking sub-path "%s" for URL "%s"' % (sub_path, url))
+    # Streams the results file and filters sub-paths that should be captured
+    target_urls = [
+        url + sub_path['path']
+        for url, sub_paths in ijson.kvitems(results_file, '')
+        for sub_path in sub_paths
+        if (not included_codes or sub_path['status'] in included_codes)
+        and sub_path['status'] not in excluded_codes]
 
-            status_code = sub_path['status']
-            path = sub_path['path']
+    # Shuffels the target list array to spread out the capturing load, or
+    # picks a random selection of it if the number of URLs is limited
+    if url_limit is not None and url_limit < len(target_urls):
+        target_urls = sample(target_urls, url_limit)
 
-            if status_code in excluded_codes:
-                log.debug('Status code %s should be excluded' % status_code)
+    else:
+        shuffle(target_urls)
 
-                continue
+    log.debug('Target URLs for capturing: "%s"', target_urls)
 
-            elif not included_codes or status_code in included_codes:
-                log.debug('Including status code %s' % status_code)
+    return target_urls
 
-                target_urls.append(url + path)
+# -----------------------------------------------------------------------------
 
-    # Shuffels the target list array to spread out the capturing load
-    shuffle(target_urls)
+def kill_process_group(pid):
+    '''Kills the process group of a command and all processes in it'''
 
-    log.debug('Target URLs for capturing: "%s"' % target_urls)
+    log.debug('Killing process group "%i"', pid)
 
-    return target_urls
+    try:
+        os.killpg(pid, signal.SIGKILL)
 
-# -----------------------------------------------------------------------------
+    except ProcessLookupError:
+        pass
 
-def cutycapt_exec(url, command_template, timeout):
+
+def cutycapt_exec(url, command_tokens, timeout):
     '''Executes the CutyCapt application with subprocess to target URL'''
 
-    log.info('Capturing URL "%s"...' % url)
+    log.info('Capturing URL "%s"...', url)
 
     # Creates a "safe" filename for output image
-    safe_chars = string.letters + string.digits + '-_.='
-
-    file_name = url.replace('/', '_')
-    file_name = file_name.replace(':', '-')
-    file_name = filter(lambda char: char in safe_chars, file_name)
-    file_name += '.png'
+    file_name = url.translate(file_name_table) + '.png'
 
-    log.debug('Generated filename for URL "%s": "%s"' % (url, file_name))
+    log.debug('Generated filename for URL "%s": "%s"', url, file_name)
 
     # -------------------------------------------------------------------------
-    log.debug('Building command string from template "%s"' % command_template)
+    log.debug('Building command from template tokens "%s"', command_tokens)
+
+    command = [
+        token.replace('%URL%', url).replace('%FILENAME%', file_name)
+        for token in command_tokens]
 
-    command = command_template.replace('%URL%', url)
-    command = command.replace('%FILENAME%', file_name)
+    log.debug('Executing command "%s"', command)
 
-    log.debug('Executing shell command "%s"' % command)
+    # Standard output is only captured if it will be logged
+    if log.getLogger().isEnabledFor(log.DEBUG):
+        stdout = subprocess.PIPE
+
+    else:
+        stdout = subprocess.DEVNULL
 
+    # The command is started in a new session/process group, so that it can
+    # be killed along with its children if it's wrapped (e.g. by xvfb-run).
+    # It won't receive signals sent to the terminal, so the process group is
+    # registered to be killed by main if capturing is stopped
     shell_exec = subprocess.Popen(
-        command.split(' '),
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        command, stdout=stdout, stderr=subprocess.PIPE,
+        text=True, errors='replace', start_new_session=True)
 
-    # Poll the execution status of command every 10 milliseconds
-    attempts = timeout * 10
+    with running_pids_lock:
+        running_pids.add(shell_exec.pid)
 
-    while shell_exec.poll() is None and attempts:
-        attempts -= 1
-        time.sleep(0.1)
+        if stopping_captures.is_set():
+            kill_process_group(shell_exec.pid)
 
-    if not attempts:
+    # Blocks until the command exits while draining its output
+    try:
+        output = shell_exec.communicate(timeout=timeout)
+
+    except subprocess.TimeoutExpired:
         log.error(
-            'Failed to capture "%s": Execution timed out after %i seconds'
-            % (url, timeout))
+            'Failed to capture "%s": Execution timed out after %i seconds',
+            url, timeout)
+
+        kill_process_group(shell_exec.pid)
+        shell_exec.wait()
+
+        with running_pids_lock:
+            running_pids.discard(shell_exec.pid)
 
-        log.debug('Terminating process "%i"' % shell_exec.pid)
-        shell_exec.terminate()
+        # Descendants that left the process group may still hold the pipes
+        # open, so they're closed instead of being drained until EOF
+        for pipe in (shell_exec.stdout, shell_exec.stderr):
+            if pipe is not None:
+                pipe.close()
+
+        return
+
+    with running_pids_lock:
+        running_pids.discard(shell_exec.pid)
+
+    if stopping_captures.is_set():
+        log.error('Capture of URL "%s" was stopped', url)
 
         return
 
-    output = shell_exec.communicate()
     exit_code = shell_exec.returncode
 
     log.debug(
-        'Execution status for URL "%s" - output: "%s", exit code "%i"'
-        % (url, output, exit_code))
+        'Execution status for URL "%s" - output: "%s", exit code "%i"',
+        url, output, exit_code)
 
     if exit_code != 0:
         log.error(
-            'Failed to execute CutyCapt for URL "%s": "%s"' % (url, output))
+            'Failed to execute CutyCapt for URL "%s": "%s"',
+            url, output[1].strip())
 
         return
     
     # -------------------------------------------------------------------------
-    log.info('Saving capture of URL "%s" to "%s"' % (url, file_name))
+    log.info('Saving capture of URL "%s" to "%s"', url, file_name)
 
     return
 
+# -----------------------------------------------------------------------------
 
-def cutycapt_worker(worker_id, queue, command_template, timeout):
-    '''Loads URLs from queue and runs the CutyCapt execution function'''
+def start_xvfb():
+    '''Starts a Xvfb server to be shared by all CutyCapt executions'''
 
-    log.debug('Starting CutyCap worker %i' % worker_id)
+    log.debug('Starting Xvfb server')
 
-    while True:
-        log.debug('Loading new URL from queue in worker %i' % worker_id) 
+    read_fd, write_fd = os.pipe()
+
+    try:
+        xvfb_exec = subprocess.Popen(
+            ['Xvfb', '-displayfd', str(write_fd), '-nolisten', 'tcp',
+             '-screen', '0', '1024x768x24'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            pass_fds=(write_fd,))
 
-        url = queue.get()
+    finally:
+        os.close(write_fd)
 
-        # Captures the URL with CutyCapt
-        cutycapt_exec(url, command_template, timeout)
+    # Xvfb writes its display number to the pipe once it accepts clients
+    with os.fdopen(read_fd) as display_pipe:
+        display_number = display_pipe.readline().strip()
 
-        queue.task_done()
+    if not display_number:
+        raise RuntimeError(
+            'Xvfb exited with code %i before accepting clients'
+            % xvfb_exec.wait())
+
+    return xvfb_exec, ':' + display_number
 
 # -----------------------------------------------------------------------------
 
+def exit_on_signal(signal_number, frame):
+    '''Exits on termination signals, so that running captures are stopped'''
+
+    log.error('Received signal %i - exiting!', signal_number)
+
+    exit(3)
+
+
 def main():
     '''Main application function'''
 
@@ -243,20 +367,24 @@ def main():
     else:
         log.basicConfig(level=log.INFO, format='%(levelname)s: %(message)s')
 
-    log.debug('Script has been started with arguments: "%s"' % str(args))
+    log.debug('Script has been started with arguments: "%s"', args)
+
+    for signal_number in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signal_number, exit_on_signal)
 
     # Loads results file and extracts a list of URL to CutyCapt 
     try:
         urls = load_target_urls(
-            args.results_file, args.included_codes, args.excluded_codes)
+            args.results_file, args.included_codes, args.excluded_codes,
+            args.url_limit)
 
     except Exception as error_msg:
-        log.error('Failed to load result file: "%s"' % error_msg)
+        log.error('Failed to load result file: "%s"', error_msg)
 
         exit(1)
 
     if len(urls):
-        log.info('Capturing %i URLs with CutyCapt' % len(urls))
+        log.info('Capturing %i URLs with CutyCapt', len(urls))
 
     else:
         log.error('No URLs in the result file matched filtering requirements')
@@ -264,33 +392,61 @@ def main():
         exit(1)
 
     # -------------------------------------------------------------------------
-    log.debug('Populating queue with URLs')
+    xvfb_exec = None
 
-    queue = Queue()
+    if args.use_xvfb:
+        try:
+            xvfb_exec, display = start_xvfb()
 
-    for url in urls:
-        queue.put(url)
+        except (OSError, RuntimeError) as error_msg:
+            log.error('Failed to start Xvfb server: "%s"', error_msg)
 
-    log.debug('Starting %i CutyCapt worker threads' % args.worker_threads)
+            exit(1)
 
-    for worker_id in range(args.worker_threads):
-        worker = Thread(
-            target=cutycapt_worker,
-            args=(worker_id, queue, args.command_template, args.timeout))
+        log.info('Capturing URLs on Xvfb server display "%s"', display)
 
-        worker.setDaemon(True)
-        worker.start()
+        # The display is inherited by all CutyCapt processes
+        os.environ['DISPLAY'] = display
 
-    # -------------------------------------------------------------------------
-    while not queue.empty():
-        log.info('URLs still in queue for capturing: %i' % queue.qsize())
+    try:
+        log.debug('Starting %i CutyCapt worker threads', args.worker_threads)
+
+        with ThreadPoolExecutor(max_workers=args.worker_threads) as pool:
+            futures = [
+                pool.submit(
+                    cutycapt_exec, url, args.command_tokens, args.timeout)
+                for url in urls]
+
+            try:
+                for handled, future in enumerate(as_completed(futures), 1):
+                    future.result()
+
+                    log.info(
+                        'URLs handled by capturing workers: %i of %i',
+                        handled, len(urls))
 
-        time.sleep(3)
+            finally:
+                # Cancels pending captures and kills running ones if
+                # interrupted, so shutdown of the pool doesn't wait for the
+                # remaining URLs to be captured
+                for future in futures:
+                    future.cancel()
 
-    log.info('Waiting for all URLs to be handled by capturing workers')
-    queue.join()
+                with running_pids_lock:
+                    stopping_captures.set()
 
-    log.info('Finished capturing %i URLs!' % len(urls))
+                    for pid in running_pids:
+                        kill_process_group(pid)
+
+    finally:
+        if xvfb_exec is not None:
+            log.debug('Stopping Xvfb server')
+
+            xvfb_exec.terminate()
+            xvfb_exec.wait()
+
+    # -------------------------------------------------------------------------
+    log.info('Finished capturing %i URLs!', len(urls))
 
     exit(0)
 